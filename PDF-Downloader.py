@@ -1,11 +1,12 @@
+import numpy as np
 import pandas as pd
-import glob
 import os
 import os.path
-import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import openpyxl
 import requests
+from requests.adapters import HTTPAdapter
 from requests.packages import urllib3  
-from time import sleep
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive
 
@@ -21,6 +22,12 @@ MAX_DOWNLOADS = 10
 # Maximum number of files to download at the same time
 MAX_CONCURRENT_THREADS = 5
 
+# Maximum number of files to upload to Google Drive at the same time
+MAX_CONCURRENT_UPLOADS = 8
+
+# Largest PDF file we are willing to download (in bytes)
+MAX_FILE_SIZE = 200 * 1024 * 1024
+
 # Main data directory
 DATA_DIR = 'Data'
 
@@ -36,71 +43,149 @@ DOWNLOAD_DIR = os.path.join(DATA_DIR, 'Downloads')
 # Directory for output reports and logs
 OUTPUT_DIR = os.path.join(DATA_DIR, 'Output')
 
+# Shared HTTP session so connections to the same host are reused between downloads
+# instead of doing a new TCP and TLS handshake for every file
+SESSION = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=MAX_CONCURRENT_THREADS,
+    pool_maxsize=MAX_CONCURRENT_THREADS,
+    max_retries=urllib3.util.Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+)
+SESSION.mount('http://', adapter)
+SESSION.mount('https://', adapter)
+SESSION.headers.update({'User-Agent': 'PDF-Downloader/1.0'})
+
+
+def scan_pdf_files():
+    """
+    List the PDF files in the download folder.
+    
+    Returns:
+        list: os.DirEntry objects for each PDF file (empty if the folder doesn't exist yet)
+    """
+    # os.scandir gives us the file names without an extra stat call per file
+    if not os.path.isdir(DOWNLOAD_DIR):
+        return []
+    with os.scandir(DOWNLOAD_DIR) as entries:
+        return [e for e in entries if e.name.endswith('.pdf') and e.is_file(follow_symlinks=False)]
 
 def get_existing_downloads():
     """
     Check which PDF files have already been downloaded.
     
     Returns:
-        list: IDs of PDF files that already exist in the download folder
+        set: IDs of PDF files that already exist in the download folder
     """
-    # Get list of all PDF files in the download directory
-    downloaded_files = glob.glob(os.path.join(DOWNLOAD_DIR, "*.pdf")) 
-    
     # Extract just the ID portion from each filename (removing .pdf extension)
-    existing_ids = [os.path.basename(f)[:-4] for f in downloaded_files]
+    # A set makes the "already downloaded?" checks constant time
+    existing_ids = {e.name[:-4] for e in scan_pdf_files()}
     
     return existing_ids
 
-def download_file(index, row, download_errors):
+def save_excel(df, path):
+    """
+    Write a DataFrame to an Excel file (without the index).
+    
+    Uses openpyxl's write-only mode, which writes rows straight out instead
+    of keeping every cell in memory like df.to_excel does.
+    
+    Args:
+        df: DataFrame to save
+        path: Path of the Excel file to create or overwrite
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Sheet1')
+    ws.append(list(df.columns))
+    for row in df.itertuples(index=False, name=None):
+        # Write missing values as empty cells, the same way to_excel does
+        ws.append([None if pd.isna(value) else value for value in row])
+    wb.save(path)
+
+class SkippedDownload(Exception):
+    """Raised when a response is not a PDF we want to keep."""
+
+def get_content_length(response):
+    """
+    Read the Content-Length header of a response.
+    
+    Returns:
+        int: The size in bytes, or None if the header is missing or not a valid number
+    """
+    try:
+        return int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+def download_file(index, url, download_errors):
     """
     Download a single PDF file from a URL.
     
     Args:
         index: The unique ID for this report
-        row: DataFrame row containing the URL information
-        download_errors: List to track any errors that occur
+        url: The URL to download the PDF from
+        download_errors: Dictionary mapping report IDs to their error message
     """
     success = False
+    
+    # Write to a temporary file first and only give it the .pdf name once the
+    # download is complete, so an interrupted download never looks finished
+    file_path = os.path.join(DOWNLOAD_DIR, f"{index}.pdf")
+    temp_path = file_path + '.tmp'
     try:
-        # Figure out which URL to use - prefer PDF_URL if available
-        if pd.notna(row['Pdf_URL']):
-            url = row['Pdf_URL']
-            print(f"Downloading {index} from PDF URL...")
-        else:
-            url = row['Report Html Address']
-            print(f"Downloading {index} from HTML URL...")
+        print(f"Downloading {index} from {url}...")
         
         # Download the file content
         # verify=False skips SSL certificate validation
-        response = requests.get(url, verify=False, timeout=30)
-        
-        # Check if the download was successful
-        response.raise_for_status()
+        # timeout is (connect, read) in seconds
+        # stream=True lets us write the file in chunks instead of keeping it all in memory
+        with SESSION.get(url, verify=False, timeout=(5, 30), stream=True) as response:
+            # Check if the download was successful
+            response.raise_for_status()
+            
+            # Look at the headers before reading the body, so we don't
+            # download web pages or huge files only to throw them away
+            content_type = response.headers.get('Content-Type', '').lower()
+            content_length = get_content_length(response)
+            if content_type and 'pdf' not in content_type and 'octet-stream' not in content_type:
+                raise SkippedDownload(f"URL does not point to a PDF (Content-Type: {content_type})")
+            if content_length is not None and content_length > MAX_FILE_SIZE:
+                raise SkippedDownload(f"File is too large ({content_length} bytes)")
+            
+            # Save the content to a PDF file, 64 KB at a time
+            # iter_content also undoes any gzip/deflate transfer encoding, and
+            # turns errors in the middle of the body into requests exceptions
+            # The 1 MB write buffer groups those chunks into fewer, larger disk writes
+            with open(temp_path, 'wb', buffering=1024 * 1024) as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
         
-        # Save the content to a PDF file
-        file_path = os.path.join(DOWNLOAD_DIR, f"{index}.pdf")
-        with open(file_path, 'wb') as f:
-            f.write(response.content)
+        # Move the finished file into place
+        os.replace(temp_path, file_path)
         
         success = True
     except requests.exceptions.RequestException as e:
         # Handle network or URL errors
         error_message = f"Network error: {e}"
-        download_errors.append(index)
-        download_errors.append(error_message)
+        download_errors[index] = error_message
+        print(f"Error downloading {index}: {error_message}")
+    except SkippedDownload as e:
+        # Handle responses that aren't a PDF we want to keep
+        error_message = f"Skipped: {e}"
+        download_errors[index] = error_message
         print(f"Error downloading {index}: {error_message}")
     except Exception as e:
         # Handle any other errors
         error_message = f"Unexpected error: {e}"
-        download_errors.append(index)
-        download_errors.append(error_message)
+        download_errors[index] = error_message
         print(f"Error downloading {index}: {error_message}")
     finally:
         # Report whether the download succeeded or failed
         if success:
             print(f"✓ Successfully downloaded {index}")
         else:
+            # Remove any partly written file
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
             print(f"✗ Failed to download {index}")
 
 def download_pdfs(download_queue, download_errors):
@@ -109,7 +194,7 @@ def download_pdfs(download_queue, download_errors):
     
     Args:
         download_queue: DataFrame containing reports to download
-        download_errors: List to track any errors that occur
+        download_errors: Dictionary mapping report IDs to their error message
     """
     # Create directories if they don't exist
     os.makedirs(DOWNLOAD_DIR, exist_ok=True)
@@ -119,38 +204,19 @@ def download_pdfs(download_queue, download_errors):
     total_files = len(download_queue)
     print(f"\nStarting download of {total_files} files\n")
     
-    # Create and start threads for each download
-    threads = []
-    files_started = 0
-    
-    for index, row in download_queue.iterrows():
-        # Create a thread for this download
-        thread = threading.Thread(
-            target=download_file,
-            args=(index, row, download_errors),
-            name=f"Download-{index}"
-        )
-        threads.append(thread)
-        
-        # Start the thread
-        thread.start()
-        files_started += 1
-        
-        # Show progress
-        print(f"Started download {files_started}/{total_files} ({index})")
+    # The pool keeps at most MAX_CONCURRENT_THREADS downloads running and
+    # starts the next one as soon as a worker becomes free
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_THREADS, thread_name_prefix="Download") as executor:
+        futures = {
+            executor.submit(download_file, index, url, download_errors): index
+            for index, url in zip(download_queue.index, download_queue['url'])
+        }
         
-        # If we've reached the max concurrent downloads, wait for one to finish
-        # before starting more downloads
-        while sum(1 for t in threads if t.is_alive()) >= MAX_CONCURRENT_THREADS:
-            print(f"Reached max concurrent downloads ({MAX_CONCURRENT_THREADS}). Waiting...")
-            sleep(0.5)  # Wait 0.5 second before checking again
-    
-    # Wait for all threads to complete
-    active_threads = sum(1 for t in threads if t.is_alive())
-    while active_threads > 0:
-        print(f"Waiting for {active_threads} downloads to complete...")
-        sleep(1)  # Check every 2 seconds
-        active_threads = sum(1 for t in threads if t.is_alive())
+        # Show progress as each download finishes
+        files_finished = 0
+        for future in as_completed(futures):
+            files_finished += 1
+            print(f"Finished download {files_finished}/{total_files} ({futures[future]})")
     
     # Final completion message
     print("\nAll downloads finished\n")
@@ -162,24 +228,18 @@ def create_output_report(download_queue, download_errors):
     
     Args:
         download_queue: DataFrame containing reports we tried to download
-        download_errors: List containing any errors that occurred
+        download_errors: Dictionary mapping report IDs to their error message
     """
     print("Creating download status report...")
     
     output = []
-    for index, row in download_queue.iterrows():
+    for index in download_queue.index:
         # Check if this file was downloaded successfully
         if os.path.exists(os.path.join(DOWNLOAD_DIR, f"{index}.pdf")):
             output.append([index, "Downloaded", ""])
         else:
             # Find the error message if there was one
-            error_msg = ""
-            if index in download_errors:
-                error_idx = download_errors.index(index)
-                if error_idx + 1 < len(download_errors):
-                    error_msg = str(download_errors[error_idx + 1])
-            else:
-                error_msg = "File not found"
+            error_msg = download_errors.get(index, "File not found")
             output.append([index, "Failed", error_msg])
 
     # Create a DataFrame from the output data
@@ -194,10 +254,10 @@ def create_output_report(download_queue, download_errors):
         # Read the existing file
         try:
             existing_df = pd.read_excel(output_path)
-            # Combine existing data with new data
-            output_df = pd.concat([existing_df, new_output_df], ignore_index=True)
+            # Combine existing data with new data, keyed by report ID
+            output_df = pd.concat([existing_df.set_index("Brnum"), new_output_df.set_index("Brnum")])
             # Remove duplicates, keeping the latest entry if there's a conflict
-            output_df.drop_duplicates(subset=["Brnum"], keep="last", inplace=True)
+            output_df = output_df[~output_df.index.duplicated(keep="last")].reset_index()
         except Exception as e:
             print(f"Error reading existing report file: {e}")
             print("Creating a new report file instead.")
@@ -207,7 +267,7 @@ def create_output_report(download_queue, download_errors):
         output_df = new_output_df
     
     # Save to an Excel file
-    output_df.to_excel(output_path, index=False)
+    save_excel(output_df, output_path)
     print(f'Download status report saved to: {output_path}')
 
 def update_metadata(download_queue, reports_data):
@@ -229,52 +289,43 @@ def update_metadata(download_queue, reports_data):
         metadata_df = pd.read_excel(METADATA_PATH, sheet_name=0)
         print(f"Loaded existing metadata with {len(metadata_df)} entries")
 
-    # Get list of successfully downloaded files
+    # Get set of successfully downloaded files
     downloaded_files = get_existing_downloads()
     print(f"Found {len(downloaded_files)} downloaded PDF files")
 
-    # Create a list for new metadata records
-    new_records = []
+    # Work out the download status for every report we attempted at once
+    # Convert IDs to string for consistent comparison
+    downloaded = download_queue.index.astype(str).isin(downloaded_files)
 
-    # For each file we attempted to download, create a new record
-    for report_id in download_queue.index:
-        # Convert ID to string for consistent comparison
-        status = 'Yes' if str(report_id) in downloaded_files else 'No'
-        
-        # Create a record with the same columns as the metadata file
-        new_record = {ID_COLUMN: report_id, 'pdf_downloaded': status}
-        
-        # Copy any other columns from the source file that we want to preserve
-        if report_id in reports_data.index:
-            for col in reports_data.columns:
-                # Only copy columns that exist in the metadata file and haven't been set yet
-                if col in metadata_df.columns and col not in [ID_COLUMN, 'pdf_downloaded']:
-                    new_record[col] = reports_data.loc[report_id, col]
-    
-        new_records.append(new_record)
+    # Copy any other columns from the source file that we want to preserve
+    # Only copy columns that exist in the metadata file and haven't been set yet
+    cols_to_copy = [col for col in reports_data.columns
+                    if col in metadata_df.columns and col not in [ID_COLUMN, 'pdf_downloaded']]
 
-    # Create DataFrame from new records
-    new_data = pd.DataFrame(new_records)
+    # Create the new records with the same columns as the metadata file
+    new_data = reports_data.loc[download_queue.index, cols_to_copy].copy()
+    new_data.insert(0, 'pdf_downloaded', np.where(downloaded, 'Yes', 'No'))
+    new_data = new_data.reset_index()
     print(f"Created {len(new_data)} new metadata entries")
 
     # Make a backup of the original metadata
     backup_path = os.path.join(OUTPUT_DIR, "Metadata2006_2016_Backup.xlsx")
-    metadata_df.to_excel(backup_path, index=False)
+    save_excel(metadata_df, backup_path)
     print(f"Saved metadata backup to: {backup_path}")
 
-    # Append the new data to the existing metadata
-    updated_metadata = pd.concat([metadata_df, new_data], ignore_index=True)
+    # Append the new data to the existing metadata, keyed by report ID
+    updated_metadata = pd.concat([metadata_df.set_index(ID_COLUMN), new_data.set_index(ID_COLUMN)])
 
     # Remove duplicates if any, keeping the latest entry
     before_dedup = len(updated_metadata)
-    updated_metadata.drop_duplicates(subset=[ID_COLUMN], keep='last', inplace=True)
+    updated_metadata = updated_metadata[~updated_metadata.index.duplicated(keep='last')].reset_index()
     after_dedup = len(updated_metadata)
     
     if before_dedup != after_dedup:
         print(f"Removed {before_dedup - after_dedup} duplicate entries")
 
     # Update the original metadata file
-    updated_metadata.to_excel(METADATA_PATH, index=False)
+    save_excel(updated_metadata, METADATA_PATH)
     print(f"Saved updated metadata with {len(updated_metadata)} entries to: {METADATA_PATH}")
 
 #Upload the downloaded PDF files to Google Drive.
@@ -315,7 +366,7 @@ def upload_to_drive():
         drive = GoogleDrive(gauth)
         
         # Get list of all PDF files in the download directory
-        downloaded_files = glob.glob(os.path.join(DOWNLOAD_DIR, "*.pdf"))
+        downloaded_files = [e.path for e in scan_pdf_files()]
         
         if not downloaded_files:
             print("No PDF files found to upload.")
@@ -350,19 +401,21 @@ def upload_to_drive():
             })
             print(f"Created new folder: {folder_name}")
         
-        # Upload each file to Google Drive
-        successful_uploads = 0
-        for file_path in downloaded_files:
+        # Get the names of all files already in the folder with a single listing
+        # (without maxResults, GetList keeps requesting pages until it has every file)
+        existing_files = {f['title'] for f in drive.ListFile({
+            'q': f"'{folder_id}' in parents and trashed=false"
+        }).GetList()}
+        
+        def upload_file(file_path):
+            """Upload one PDF to the folder. Returns True if it ends up in Google Drive."""
             file_name = os.path.basename(file_path)
             
             try:
                 # Check if file already exists
-                existing_files = drive.ListFile({'q': f"title='{file_name}' and '{folder_id}' in parents and trashed=false"}).GetList()
-                
-                if existing_files:
+                if file_name in existing_files:
                     print(f"File {file_name} already exists in Google Drive. Skipping.")
-                    successful_uploads += 1
-                    continue
+                    return True
                 
                 # Create a file on Google Drive
                 drive_file = drive.CreateFile({
@@ -378,11 +431,15 @@ def upload_to_drive():
                 
                 # Report the status
                 print(f"✓ Uploaded {file_name} to Google Drive")
-               
-                successful_uploads += 1
+                return True
             
             except Exception as e:
                 print(f"✗ Error uploading {file_name}: {str(e)}")
+                return False
+        
+        # Upload the files to Google Drive in parallel
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS, thread_name_prefix="Upload") as executor:
+            successful_uploads = sum(executor.map(upload_file, downloaded_files))
 
         # Print the folder link and upload status      
         print(f"\nUploaded {successful_uploads} of {len(downloaded_files)} files to Google Drive")
@@ -415,21 +472,23 @@ def main():
     
     # Keep only rows with valid download URLs
     print("\nFinding reports with valid download URLs...")
-    has_valid_url = (reports_data.Pdf_URL.notnull()) | (reports_data['Report Html Address'].notnull())
-    reports_data = reports_data[has_valid_url]
+    # A report is only skipped if both URL columns are missing
+    has_valid_url = ~(reports_data['Pdf_URL'].isna().to_numpy() & reports_data['Report Html Address'].isna().to_numpy())
+    reports_data = reports_data.iloc[has_valid_url]
+    
+    # Pick the URL to download from for each report - prefer Pdf_URL if available
+    reports_data = reports_data.assign(url=reports_data['Pdf_URL'].fillna(reports_data['Report Html Address']))
     print(f"   Found {len(reports_data)} reports with valid URLs")
     
-    # Make a copy for download processing
-    download_queue = reports_data.copy()
-
     # Check which files have already been downloaded
     print("\nChecking for previously downloaded reports...")
     existing_downloads = get_existing_downloads()
     print(f"   Found {len(existing_downloads)} already downloaded PDFs")
     
     # Remove files that have already been downloaded
-    to_download = [idx for idx in download_queue.index if str(idx) not in existing_downloads]
-    download_queue = download_queue.loc[to_download]
+    # .loc returns a new DataFrame, so reports_data is left untouched for update_metadata
+    to_download = [idx for idx in reports_data.index if str(idx) not in existing_downloads]
+    download_queue = reports_data.loc[to_download]
     print(f"   {len(download_queue)} reports need to be downloaded")
 
     # Limit batch size to prevent overloading
@@ -439,8 +498,8 @@ def main():
     else:
         print(f"\nWill download all {len(download_queue)} reports")
 
-    # List to track any errors that occur during downloading
-    download_errors = []
+    # Dictionary to track any errors that occur during downloading (report ID -> message)
+    download_errors = {}
 
     # Download the PDFs
     if len(download_queue) > 0: